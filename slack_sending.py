@@ -9,8 +9,9 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Initialize Slack client
+SLACK_TIMEOUT = 60  # seconds per Slack API call, so a hung upload can't stall the run
 slack_token = os.getenv('slack_bot_token')  # Slack bot token from environment variables
-client = WebClient(token=slack_token)
+client = WebClient(token=slack_token, timeout=SLACK_TIMEOUT)
 slack_channel = os.getenv('slack_channel')  # Slack channel ID from environment variables
 
 # Function to send a file to Slack
@@ -18,8 +19,8 @@ def send_file_to_slack(filepath: str, repo_name: str):
     try:
         print(f"Preparing to send file {filepath} for {repo_name}")
         if os.path.exists(filepath):
-            result = client.files_upload(
-                channels=slack_channel,
+            result = client.files_upload_v2(
+                channel=slack_channel,
                 file=filepath,
                 title=f"TruffleHog results for {repo_name}",
             )
@@ -30,13 +31,38 @@ def send_file_to_slack(filepath: str, repo_name: str):
         print(f"Error sending file to Slack: {e.response['error']}")
         print(f"Full response: {e.response}")
 
+# Function to send several files to Slack in one upload, with the summary as the comment
+def send_files_to_slack(file_paths: list):
+    try:
+        file_uploads = []
+        for file_path in file_paths:
+            repo_name = os.path.basename(file_path).split('_th_results.txt')[0]
+            file_uploads.append({"file": file_path, "title": f"TruffleHog results for {repo_name}"})
+        summary_message = build_summary_message(file_paths)
+
+        print(f"Preparing to send {len(file_uploads)} files to Slack")
+        result = client.files_upload_v2(
+            channel=slack_channel,
+            file_uploads=file_uploads,
+            initial_comment=summary_message,
+        )
+        print(f"{len(file_uploads)} files sent to Slack channel {slack_channel}")
+    except SlackApiError as e:
+        print(f"Error sending files to Slack: {e.response['error']}")
+        print(f"Full response: {e.response}")
+
+# Function to build the scan summary text for a list of result files
+def build_summary_message(file_list: list) -> str:
+    number_of_files = len(file_list)
+    _basename = os.path.basename
+    file_names = "\n".join(f"`Trufflehog result for {name}`" for name in map(_basename, file_list))
+    return f"Trufflehog Scan started on {number_of_files} images.\n{file_names}"
+
 # Function to send a summary message to Slack
 def send_summary_to_slack(file_list: list):
     try:
-        number_of_files = len(file_list)
-        file_names = "\n".join([f"`Trufflehog result for {os.path.basename(file)}`" for file in file_list])
-        summary_message = f"Trufflehog Scan started on {number_of_files} images.\n{file_names}"
-        
+        summary_message = build_summary_message(file_list)
+
         print(f"Attempting to send summary message to Slack...")
         response = client.chat_postMessage(
             channel=slack_channel,
@@ -66,7 +92,7 @@ def main():
     subparsers = parser.add_subparsers(dest='command', help='Sub-commands: send_files, send_summary, send_message')
 
     # Sub-parser for sending files
-    parser_files = subparsers.add_parser('send_files', help='Send multiple files to Slack.')
+    parser_files = subparsers.add_parser('send_files', help='Send multiple files to Slack along with a summary message.')
     parser_files.add_argument('file_paths', nargs='+', type=str, help='Paths to the files to send')
 
     # Sub-parser for sending summary messages
@@ -81,14 +107,17 @@ def main():
     args = parser.parse_args()
 
     if args.command == 'send_files':
+        file_paths = []
         for file_path in args.file_paths:
             file_path = os.path.abspath(file_path)
             # Check if the provided file exists
             if not os.path.isfile(file_path):
                 print(f"Error: The file {file_path} does not exist.")
                 continue
-            repo_name = os.path.basename(file_path).split('_th_results.txt')[0]
-            send_file_to_slack(file_path, repo_name)
+            file_paths.append(file_path)
+        # Upload all files and the summary in a single request
+        if file_paths:
+            send_files_to_slack(file_paths)
     
     elif args.command == 'send_summary':
         send_summary_to_slack(args.file_list)
@@ -3,26 +3,95 @@ import subprocess
 import os
 import sqlite3
 import pytz
+import threading
+import time
+import json
 import tempfile
-import shutil
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables
 load_dotenv()
 
 # Initialize Slack client
+SLACK_TIMEOUT = 60  # seconds per Slack API call
 slack_token = os.getenv('slack_bot_token')
-client = WebClient(token=slack_token)
+client = WebClient(token=slack_token, timeout=SLACK_TIMEOUT)
 slack_channel = os.getenv('slack_channel')
 namespace = os.getenv('namespace')
 
+# Concurrency settings
+SCAN_MAX_WORKERS = 4  # Number of images scanned in parallel
+TAGS_MAX_WORKERS = 8  # Number of repositories whose tags are listed in parallel
+DB_FLUSH_EVERY = 5  # Scan results written to the database per transaction
+WATERMARK_MARGIN = timedelta(minutes=5)  # Overlap between runs to absorb clock skew with Docker Hub
+SLACK_MAX_CONCURRENT_REQUESTS = 3  # Cap on in-flight Slack API calls
+
+# The single sqlite connection is shared across threads, so serialize DB access
+db_lock = threading.Lock()
+slack_semaphore = threading.BoundedSemaphore(SLACK_MAX_CONCURRENT_REQUESTS)
+
+# Environment for docker CLI calls, without the "What's next" hints
+DOCKER_ENV = {**os.environ, 'DOCKER_CLI_HINTS': 'false'}
+
+# HTTP settings
+HTTP_TIMEOUT = (5.0, 30.0)  # (connect, read) seconds
+DOCKERHUB_MAX_REQUESTS_PER_SECOND = 10  # Shared cap across all Docker Hub requests and threads
+
+# Space out requests so concurrent workers stay under a fixed request rate
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_allowed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_allowed - now
+            self.next_allowed = max(now, self.next_allowed) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+dockerhub_limiter = RateLimiter(DOCKERHUB_MAX_REQUESTS_PER_SECOND)
+
+# Session that waits on the rate limiter before every request
+class RateLimitedSession(requests.Session):
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, *args, **kwargs):
+        self.limiter.wait()
+        return super().request(*args, **kwargs)
+
+# Build a pooled, keep-alive session so repeated calls reuse the same TLS connection
+def make_session():
+    session = RateLimitedSession(dockerhub_limiter)
+    # 429s back off and honor Docker Hub's Retry-After header instead of failing the scan;
+    # once retries are exhausted the last response is returned so callers can check its status
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                    respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+hub_session = make_session()  # hub.docker.com
+
 # Database initialization
 def initialize_db():
-    conn = sqlite3.connect('images.db')
+    # One connection is held for the whole run; access is serialized with db_lock
+    conn = sqlite3.connect('images.db', check_same_thread=False)
     cursor = conn.cursor()
+    # WAL lets readers proceed while a write is in progress
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
     # Create the images table if it doesn't exist
     cursor.execute('''CREATE TABLE IF NOT EXISTS images (
                         image_name TEXT,
@@ -38,8 +107,12 @@ def initialize_db():
         cursor.execute("ALTER TABLE images ADD COLUMN digest TEXT")
     if 'vulnerabilities_count' not in columns:
         cursor.execute("ALTER TABLE images ADD COLUMN vulnerabilities_count INTEGER")
+    # Per-repo time up to which every tag has been discovered and its result stored
+    cursor.execute('''CREATE TABLE IF NOT EXISTS repo_watermarks (
+                        image_name TEXT PRIMARY KEY,
+                        watermark TEXT)''')
     conn.commit()
-    conn.close()
+    return conn
 
 # Fetch all repositories from the namespace
 def get_all_repositories(namespace):
@@ -47,7 +120,11 @@ def get_all_repositories(namespace):
     url = f"https://hub.docker.com/v2/repositories/{namespace}/"
     params = {'page_size': 100}
     while url:
-        response = requests.get(url, params=params)
+        try:
+            response = hub_session.get(url, params=params, timeout=HTTP_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"Error fetching repositories: {e}")
+            break
         if response.status_code != 200:
             print(f"Error fetching repositories: {response.status_code}")
             break
@@ -57,176 +134,295 @@ def get_all_repositories(namespace):
         params = {}
     return repos
 
-# Fetch all tags for a specific repository
-def get_all_tags(namespace, repository):
+# Parse a Docker Hub ISO 8601 timestamp (e.g. 2024-05-01T10:00:00.123456Z)
+def parse_hub_timestamp(timestamp):
+    try:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+
+# Fetch all tags for a specific repository, newest first, with their digests.
+# Tags last updated before `since` were already handled on a previous run, so paging stops there.
+# Returns None if the listing could not be completed.
+def get_all_tags(namespace, repository, since=None):
     tags = []
     url = f"https://hub.docker.com/v2/repositories/{namespace}/{repository}/tags/"
-    params = {'page_size': 100}
+    params = {'page_size': 100, 'ordering': 'last_updated'}
     while url:
-        response = requests.get(url, params=params)
+        try:
+            response = hub_session.get(url, params=params, timeout=HTTP_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"Error fetching tags for {repository}: {e}")
+            return None
         if response.status_code != 200:
             print(f"Error fetching tags for {repository}: {response.status_code}")
-            break
+            return None
         data = response.json()
-        tags.extend([tag['name'] for tag in data.get('results', [])])
+        for tag in data.get('results', []):
+            last_updated = parse_hub_timestamp(tag.get('last_updated'))
+            if since and last_updated and last_updated < since:
+                return tags
+            images = tag.get('images') or [{}]
+            tags.append({
+                'name': tag['name'],
+                'digest': tag.get('digest') or images[0].get('digest'),
+            })
         url = data.get('next')
         params = {}
     return tags
 
-# Get the image digest from Docker Registry API
-def get_image_digest(namespace, repository, tag):
-    # Get the authentication token
-    token_url = f"https://auth.docker.io/token?service=registry.docker.io&scope=repository:{namespace}/{repository}:pull"
-    token_response = requests.get(token_url)
-    #print(f"Token request status code: {token_response.status_code}")
-    #print(f"Token response content: {token_response.text}")
-    if token_response.status_code != 200:
-        print(f"Error fetching token for {namespace}/{repository}:{tag}: {token_response.status_code}")
-        return None
-    token = token_response.json().get('token')
-    if not token:
-        print(f"No token found for {namespace}/{repository}:{tag}")
-        return None
+# Load every stored digest into memory, keyed on "image:tag"
+def load_known_digests(conn):
+    with db_lock:
+        cursor = conn.cursor()
+        cursor.execute("SELECT image_name || ':' || tag, digest FROM images")
+        return dict(cursor.fetchall())
 
-    # Send a HEAD request to get the digest
-    manifest_url = f"https://registry-1.docker.io/v2/{namespace}/{repository}/manifests/{tag}"
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Accept': 'application/vnd.docker.distribution.manifest.v2+json'
-    }
-    response = requests.head(manifest_url, headers=headers)
-    # print(f"Digest request status code: {response.status_code}")
-    # print(f"Digest response headers: {response.headers}")
-    if response.status_code != 200:
-        print(f"Error fetching digest for {namespace}/{repository}:{tag}: {response.status_code}")
-        return None
-    digest = response.headers.get('Docker-Content-Digest')
-    # print(f"Digest for {namespace}/{repository}:{tag}: {digest}")
-    return digest
+# Load the vulnerabilities_count already recorded for each scanned digest
+def load_known_vulnerability_counts(conn):
+    with db_lock:
+        cursor = conn.cursor()
+        cursor.execute("SELECT digest, vulnerabilities_count FROM images WHERE digest IS NOT NULL AND vulnerabilities_count IS NOT NULL")
+        return dict(cursor.fetchall())
 
+# Load each repository's discovery watermark as a timezone-aware datetime
+def load_watermarks(conn):
+    with db_lock:
+        cursor = conn.cursor()
+        cursor.execute("SELECT image_name, watermark FROM repo_watermarks")
+        rows = cursor.fetchall()
+    watermarks = {}
+    for image_name, watermark in rows:
+        try:
+            watermarks[image_name] = datetime.fromisoformat(watermark)
+        except (TypeError, ValueError):
+            continue
+    return watermarks
 
-# Update image information in the database
-def update_db(image_name, tag, digest, vulnerabilities_count):
-    conn = sqlite3.connect('images.db')
-    cursor = conn.cursor()
-    # Get current time in IST
-    ist = pytz.timezone('Asia/Kolkata')
-    current_time_ist = datetime.now(ist).strftime('%Y-%m-%d %H:%M:%S')
+# Advance the watermarks of repositories whose changed tags have all been stored
+def update_watermarks(conn, watermarks):
+    with db_lock, conn:
+        conn.executemany("INSERT OR REPLACE INTO repo_watermarks (image_name, watermark) VALUES (?, ?)",
+                         [(repo, watermark.isoformat()) for repo, watermark in watermarks.items()])
 
-    cursor.execute('''INSERT OR REPLACE INTO images (image_name, tag, digest, last_updated_image_timestamp, vulnerabilities_count)
-                      VALUES (?, ?, ?, ?, ?)''', (image_name, tag, digest, current_time_ist, vulnerabilities_count))
-    conn.commit()
-    conn.close()
+# Update image information in the database for a batch of scanned images
+def update_db(conn, rows):
+    with db_lock, conn:
+        conn.executemany('''INSERT OR REPLACE INTO images (image_name, tag, digest, last_updated_image_timestamp, vulnerabilities_count)
+                            VALUES (?, ?, ?, ?, ?)''', rows)
 
 # Send a Slack message
 def send_message_to_slack(message):
     try:
-        response = client.chat_postMessage(
-            channel=slack_channel,
-            text=message
-        )
+        with slack_semaphore:
+            response = client.chat_postMessage(
+                channel=slack_channel,
+                text=message
+            )
         print("Message sent to Slack successfully.")
     except SlackApiError as e:
         print(f"Error sending message to Slack: {e.response['error']}")
 
-# TruffleHog scan on extracted filesystem
-def run_trufflehog(image_tag):
-    print(f"Running TruffleHog on extracted filesystem of {image_tag}")
-    temp_dir = tempfile.mkdtemp()
-    container_name = f"temp_container_{image_tag.replace('/', '_').replace(':', '_')}"
-    vulnerabilities_count = 0
-    try:
+# Render a single TruffleHog JSON finding as a human-readable line
+def format_finding(record):
+    source_data = record.get('SourceMetadata', {}).get('Data', {})
+    # Data is keyed by source type (Docker, Filesystem, ...), each carrying a file path
+    location = next(iter(source_data.values()), {})
+    file_path = location.get('file', 'unknown file')
+    status = 'verified' if record.get('Verified') else 'unverified'
+    return f"[{record.get('DetectorName')}] {file_path}: {status}\n  Raw result: {record.get('Raw')}"
+
+# Check whether an image reference is already present in the local Docker daemon
+def image_present_locally(image_ref):
+    result = subprocess.run(['docker', 'image', 'inspect', '--format', '{{.Id}}', image_ref],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=DOCKER_ENV)
+    return result.returncode == 0
+
+# TruffleHog scan on the pulled image, read straight from the local Docker daemon.
+# digest_ref (namespace/repo@sha256:...) lets an already cached copy of the exact image skip the pull.
+# Raises subprocess.CalledProcessError if the image can't be pulled or scanned, so a failed scan is never
+# recorded (or reused for other tags) as a clean one.
+def run_trufflehog(image_tag, digest_ref=None):
+    print(f"Running TruffleHog on image {image_tag}")
+    if digest_ref and image_present_locally(digest_ref):
+        print(f"{digest_ref} is already present locally, skipping pull.")
+        scan_target = digest_ref
+    else:
         # Pull the image with platform specification
-        subprocess.run(['docker', 'pull', '--platform', 'linux/amd64', image_tag], check=True)
-
-        # Create a temporary container with platform specification
-        subprocess.run(['docker', 'create', '--platform', 'linux/amd64', '--name', container_name, image_tag], check=True)
-
-        # Export the container's filesystem and extract it to the temp directory
-        export_cmd = ['docker', 'export', container_name]
-        with subprocess.Popen(export_cmd, stdout=subprocess.PIPE) as proc:
-            with subprocess.Popen(['tar', '-x', '-C', temp_dir], stdin=proc.stdout) as tar_proc:
-                proc.stdout.close()
-                tar_proc.communicate()
-
-        # First Run: Generate human-readable output for Slack
-        command = ['trufflehog', 'filesystem', temp_dir, '--only-verified']
-        result = subprocess.run(command, capture_output=True, text=True)
-        scan_results = result.stdout
-
-        # Second Run: Generate JSON output for counting vulnerabilities
-        command_json = ['trufflehog', 'filesystem', temp_dir, '--only-verified', '--json']
-        result_json = subprocess.run(command_json, capture_output=True, text=True)
-        scan_results_json = result_json.stdout
-
-        # Parse JSON lines and count vulnerabilities
-        vulnerabilities_count = 0
-        for line in scan_results_json.strip().split('\n'):
-            if line.strip():
-                vulnerabilities_count += 1  # Each JSON line represents a finding
-
-    except subprocess.CalledProcessError as e:
-        print(f"Error during scanning {image_tag}: {e}")
-        scan_results = f"Error during scanning {image_tag}: {e}"
-    finally:
-        # Clean up: remove temporary container and directory
-        subprocess.run(['docker', 'rm', container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        shutil.rmtree(temp_dir)
-    return scan_results, vulnerabilities_count
+        subprocess.run(['docker', 'pull', '--quiet', '--platform', 'linux/amd64', image_tag], check=True, env=DOCKER_ENV)
+        scan_target = image_tag
 
+    # TruffleHog walks the image layers itself, so there is no container to create
+    # and no filesystem to export and extract to disk
+    image_ref = f"docker://{scan_target}"
 
-# Main function
-def scan_images(namespace):
-    initialize_db()
+    # Single run with JSON output; the human-readable text for Slack is built from it
+    command_json = ['trufflehog', 'docker', '--image', image_ref, '--only-verified', '--json']
 
+    # Stream JSON lines as they are produced; each line represents a finding.
+    # stderr goes to a temp file so TruffleHog's logging can't block the stdout pipe.
+    findings = []
+    with tempfile.TemporaryFile(mode='w+') as stderr_file:
+        with subprocess.Popen(command_json, stdout=subprocess.PIPE, stderr=stderr_file, text=True, bufsize=1) as proc:
+            for line in proc.stdout:
+                if line.strip():
+                    findings.append(format_finding(json.loads(line)))
+        if proc.returncode != 0:
+            # A crash, an unreachable daemon or an unreadable image must not look like a clean scan
+            stderr_file.seek(0)
+            stderr_output = stderr_file.read()
+            print(f"TruffleHog failed on {image_tag} with exit code {proc.returncode}:\n{stderr_output[-2000:]}")
+            raise subprocess.CalledProcessError(proc.returncode, command_json, stderr=stderr_output)
+    vulnerabilities_count = len(findings)
+    scan_results = "\n".join(findings)
+    return scan_results, vulnerabilities_count
+
+
+# Find image:tag pairs whose digest is new or has changed since the last run.
+# Also returns the tags that alias a digest already queued for scanning in this run, and the
+# watermark each fully listed repository may advance to once its changed tags are stored.
+def discover_changed_images(conn, namespace):
+    # Anything pushed after this point is picked up by the next run
+    discovery_started = datetime.now(timezone.utc) - WATERMARK_MARGIN
+    known_digests = load_known_digests(conn)
+    known_counts = load_known_vulnerability_counts(conn)
+    watermarks = load_watermarks(conn)
     repos = get_all_repositories(namespace)
     images_to_scan = []  # List of images that need to be scanned
+    reused_rows = []  # Rows for images whose digest was already scanned under another tag
+    aliases = {}  # digest -> [(repo, tag)] sharing a digest queued for scanning in this run
+    new_watermarks = {}
+
+    # List the tags of every repository concurrently; Docker Hub returns their digests too
+    with ThreadPoolExecutor(max_workers=TAGS_MAX_WORKERS) as executor:
+        tag_lists = dict(zip(repos, executor.map(lambda repo: get_all_tags(namespace, repo, watermarks.get(repo)), repos)))
 
     for repo in repos:
-        tags = get_all_tags(namespace, repo)
-        for tag in tags:
-            image_name = repo
-            # Get the digest for the image:tag
-            digest = get_image_digest(namespace, repo, tag)
-            if digest is None:
-                continue  # Skip if we couldn't get the digest
-            # Get the stored digest from the database
-            conn = sqlite3.connect('images.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT digest FROM images WHERE image_name=? AND tag=?', (image_name, tag))
-            result = cursor.fetchone()
-            conn.close()
-            if result:
-                stored_digest = result[0]
+        tags = tag_lists[repo]
+        if tags is None:
+            continue  # Listing failed, keep the old watermark so the next run retries
+        if all(tag['digest'] for tag in tags):
+            # Tags without a digest are skipped and never stored, so they hold the watermark back
+            new_watermarks[repo] = discovery_started
+        tag_digests = [(tag['name'], tag['digest']) for tag in tags]
+        for image_name, tag, digest in find_changed_tags(known_digests, repo, tag_digests):
+            if digest in known_counts:
+                # Same image content was already scanned (e.g. latest aliasing a version tag)
+                print(f"Digest of {image_name}:{tag} was already scanned, reusing its result.")
+                current_time_ist = datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S')
+                reused_rows.append((image_name, tag, digest, current_time_ist, known_counts[digest]))
+            elif digest in aliases:
+                # Same image content is already queued under another tag, reuse that scan
+                print(f"Digest of {image_name}:{tag} is already queued for scanning, reusing its result.")
+                aliases[digest].append((image_name, tag))
             else:
-                stored_digest = None
-            if digest != stored_digest:
-                # Image is new or updated, need to scan
-                images_to_scan.append((repo, tag, digest))
-            else:
-                print(f"No changes detected for {image_name}:{tag}, skipping scan.")
+                aliases[digest] = []
+                images_to_scan.append((image_name, tag, digest))
+    return images_to_scan, reused_rows, aliases, new_watermarks
+
+# Compare fetched digests of a repo's tags against the database
+def find_changed_tags(known_digests, repo, tag_digests):
+    changed = []
+    image_name = repo
+    for tag, digest in tag_digests:
+        if digest is None:
+            continue  # Skip if we couldn't get the digest
+        stored_digest = known_digests.get(f"{image_name}:{tag}")
+        if digest != stored_digest:
+            # Image is new or updated, need to scan
+            changed.append((repo, tag, digest))
+        else:
+            print(f"No changes detected for {image_name}:{tag}, skipping scan.")
+    return changed
+
+# Alert on a tag that carries an already scanned image with known vulnerabilities
+def report_reused_result(repo, tag, vulnerabilities_count):
+    if vulnerabilities_count > 0:
+        send_message_to_slack(f":alert: {repo}:{tag} has the same digest as an image where TruffleHog found {vulnerabilities_count} vulnerabilities.")
+
+# Scan a single image:tag, report it to Slack and return its database row.
+# Scan failures propagate, so the caller stores no row and the tag is retried next run.
+def scan_one(namespace, repo, tag, digest):
+    image_tag = f"{namespace}/{repo}:{tag}"
+    scan_results, vulnerabilities_count = run_trufflehog(image_tag, f"{namespace}/{repo}@{digest}")
+
+    # Get current time in IST
+    ist = pytz.timezone('Asia/Kolkata')
+    current_time_ist = datetime.now(ist).strftime('%Y-%m-%d %H:%M:%S')
+
+    # Slack message for each scan
+    if vulnerabilities_count > 0:
+        scan_message = (f":alert: TruffleHog found {vulnerabilities_count} vulnerabilities in {repo}:{tag}.\nVerified results are:\n```\n{scan_results}\n```")
+    else:
+        scan_message = f"No vulnerabilities found in {repo}:{tag}."
+    send_message_to_slack(scan_message)
+    return (repo, tag, digest, current_time_ist, vulnerabilities_count)
+
+# Collect the database rows for a finished scan and for the tags aliasing its digest
+def record_scan_result(future, scan_info, aliases, watermarks, rows):
+    repo, tag, digest = scan_info
+    try:
+        row = future.result()
+    except Exception as e:
+        print(f"Error scanning {repo}:{tag}: {e}")
+        # A failed pull or scan stores no row for these tags, so their repos keep
+        # the old watermark and are listed again next run
+        for failed_repo, failed_tag in [(repo, tag)] + aliases[digest]:
+            if watermarks.pop(failed_repo, None) is not None:
+                print(f"Keeping the watermark of {failed_repo} so {failed_repo}:{failed_tag} is retried.")
+        return
+    rows.append(row)
+    # Tags sharing this digest get the same result without another scan
+    for alias_repo, alias_tag in aliases[digest]:
+        rows.append((alias_repo, alias_tag, digest, row[3], row[4]))
+        report_reused_result(alias_repo, alias_tag, row[4])
+
+# Main function
+def scan_images(namespace):
+    conn = initialize_db()
+
+    images_to_scan, reused_rows, aliases, watermarks = discover_changed_images(conn, namespace)
+    # Record aliased tags straight away, they don't need a scan
+    if reused_rows:
+        update_db(conn, reused_rows)
+        for repo, tag, digest, _, vulnerabilities_count in reused_rows:
+            report_reused_result(repo, tag, vulnerabilities_count)
 
     if images_to_scan:
         # Slack message: Number of images and tags to be scanned
         message = (f"Number of Public Docker images to be scanned: {len(images_to_scan)}.\nScan started at {datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S')} IST.")
         send_message_to_slack(message)
 
-        # Start scanning each image:tag and send results to Slack
-        for repo, tag, digest in images_to_scan:
-            image_tag = f"{namespace}/{repo}:{tag}"
-            scan_results, vulnerabilities_count = run_trufflehog(image_tag)
-
-            # Update the database with new digest and vulnerabilities_count
-            update_db(repo, tag, digest, vulnerabilities_count)
-
-            # Slack message for each scan
-            if vulnerabilities_count > 0:
-                scan_message = (f":alert: TruffleHog found {vulnerabilities_count} vulnerabilities in {repo}:{tag}.\nVerified results are:\n```\n{scan_results}\n```")
-            else:
-                scan_message = f"No vulnerabilities found in {repo}:{tag}."
-            send_message_to_slack(scan_message)
+        # Scan images in parallel and send results to Slack as each one finishes
+        rows = []
+        executor = ThreadPoolExecutor(max_workers=SCAN_MAX_WORKERS)
+        futures = {executor.submit(scan_one, namespace, repo, tag, digest): (repo, tag, digest)
+                   for repo, tag, digest in images_to_scan}
+        recorded = set()
+        try:
+            for future in as_completed(futures):
+                recorded.add(future)
+                record_scan_result(future, futures[future], aliases, watermarks, rows)
+                # Persist results in small batches so an interrupted run keeps what it already reported
+                if len(rows) >= DB_FLUSH_EVERY:
+                    update_db(conn, rows)
+                    rows = []
+        finally:
+            # On interruption, drop queued scans so nothing is posted to Slack without being stored;
+            # scans already running finish and their results are kept below
+            executor.shutdown(wait=True, cancel_futures=True)
+            for future, scan_info in futures.items():
+                if future not in recorded and future.done() and not future.cancelled():
+                    record_scan_result(future, scan_info, aliases, watermarks, rows)
+            # Update the database with the remaining digests and vulnerabilities_count
+            if rows:
+                update_db(conn, rows)
     else:
         print("No new or updated images to scan.")
 
+    # Only reached when the run wasn't interrupted, so every remaining repo is fully stored
+    update_watermarks(conn, watermarks)
+    conn.close()
+
 if __name__ == "__main__":
     scan_images(namespace)